@@ -1,14 +1,14 @@
 import numpy as np
-import copy
-import itertools
 import collections
-from collections import namedtuple
 import mediapipe_utils as mpu
 import depthai as dai
 import cv2
 from pathlib import Path
 import time
 import argparse
+import logging
+
+logger = logging.getLogger(__name__)
 
 characters = ['A', 'B', 'C', 'D', 
               'E', 'F', 'G', 'H', 
@@ -25,6 +25,23 @@ JOINT_COLOR = [(0, 0, 0), (125, 255, 79),
             (255, 102, 0), (181, 70, 255), 
             (13, 63, 255)]
 
+# Landmark indices of each finger, from the base to the tip
+FINGER_CONNECTIONS = [[0, 1, 2, 3, 4],
+                      [5, 6, 7, 8],
+                      [9, 10, 11, 12],
+                      [13, 14 , 15, 16],
+                      [17, 18, 19, 20]]
+
+PALM_POINTS = [0, 5, 9, 13, 17, 0]
+
+# Corners of the normalized landmark space matching region.rect_points[1:]
+LM_REF_POINTS = np.array([(0, 0), (1, 0), (1, 1)], dtype=np.float32)
+
+# Keyboard shortcuts toggling the display options of HandTrackerASL
+TOGGLE_KEYS = {ord('1'): 'show_hand_box',
+               ord('2'): 'show_landmarks',
+               ord('3'): 'show_asl'}
+
 # def to_planar(arr: np.ndarray, shape: tuple) -> list:
 def to_planar(arr: np.ndarray, shape: tuple) -> np.ndarray:
     resized = cv2.resize(arr, shape, interpolation=cv2.INTER_NEAREST).transpose(2,0,1)
@@ -68,12 +85,13 @@ class HandTrackerASL:
         
         self.anchors = mpu.generate_anchors(anchor_options)
         self.nb_anchors = self.anchors.shape[0]
-        print(f"{self.nb_anchors} anchors have been created")
+        logger.info("%d anchors have been created", self.nb_anchors)
 
         self.preview_width = 576
         self.preview_height = 324
 
         self.frame_size = None
+        self.annotated_frame = None
 
         self.ft = cv2.freetype.createFreeType2()
         self.ft.loadFontData(fontFileName='HelveticaNeue.ttf', id=0)
@@ -90,12 +108,12 @@ class HandTrackerASL:
 
 
     def create_pipeline(self):
-        print("Creating pipeline...")
+        logger.info("Creating pipeline...")
         pipeline = dai.Pipeline()
         pipeline.setOpenVINOVersion(version = dai.OpenVINO.Version.VERSION_2021_2)
         self.pd_input_length = 128
 
-        print("Creating Color Camera...")
+        logger.info("Creating Color Camera...")
         cam = pipeline.createColorCamera()
         cam.setPreviewSize(self.preview_width, self.preview_height)
         cam.setInterleaved(False)
@@ -104,7 +122,7 @@ class HandTrackerASL:
         cam_out.setStreamName("cam_out")
         cam.preview.link(cam_out.input)
 
-        print("Creating Palm Detection Neural Network...")
+        logger.info("Creating Palm Detection Neural Network...")
         pd_nn = pipeline.createNeuralNetwork()
         pd_nn.setBlobPath(str(Path(self.pd_path).resolve().absolute()))
         pd_in = pipeline.createXLinkIn()
@@ -114,7 +132,7 @@ class HandTrackerASL:
         pd_out.setStreamName("pd_out")
         pd_nn.out.link(pd_out.input)
 
-        print("Creating Hand Landmark Neural Network...")          
+        logger.info("Creating Hand Landmark Neural Network...")          
         lm_nn = pipeline.createNeuralNetwork()
         lm_nn.setBlobPath(str(Path(self.lm_path).resolve().absolute()))
         self.lm_input_length = 224
@@ -125,7 +143,7 @@ class HandTrackerASL:
         lm_out.setStreamName("lm_out")
         lm_nn.out.link(lm_out.input)
 
-        print("Creating Hand ASL Recognition Neural Network...")          
+        logger.info("Creating Hand ASL Recognition Neural Network...")          
         asl_nn = pipeline.createNeuralNetwork()
         asl_nn.setBlobPath(str(Path(self.asl_path).resolve().absolute()))
         self.asl_input_length = 224
@@ -136,7 +154,7 @@ class HandTrackerASL:
         asl_out.setStreamName("asl_out")
         asl_nn.out.link(asl_out.input)
 
-        print("Pipeline created.")
+        logger.info("Pipeline created.")
         return pipeline
 
 
@@ -155,92 +173,45 @@ class HandTrackerASL:
         region.lm_score = inference.getLayerFp16("Identity_1")[0]    
         region.handedness = inference.getLayerFp16("Identity_2")[0]
         lm_raw = np.array(inference.getLayerFp16("Squeeze"))
-        
-        lm = []
-        for i in range(int(len(lm_raw)/3)):
-            # x,y,z -> x/w,y/h,z/w (here h=w)
-            lm.append(lm_raw[3*i:3*(i+1)]/self.lm_input_length)
-        region.landmarks = lm
+
+        # x,y,z -> x/w,y/h,z/w (here h=w)
+        region.landmarks = lm_raw.reshape(-1, 3) / self.lm_input_length
 
 
     def lm_render(self, frame, original_frame, region):
         cropped_frame = None
         hand_bbox = []
         if region.lm_score > self.lm_score_threshold:
-            palmar = True
-            src = np.array([(0, 0), (1, 0), (1, 1)], dtype=np.float32)
-            dst = np.array([ (x, y) for x,y in region.rect_points[1:]], dtype=np.float32) # region.rect_points[0] is left bottom point !
-            mat = cv2.getAffineTransform(src, dst)
-            lm_xy = np.expand_dims(np.array([(l[0], l[1]) for l in region.landmarks]), axis=0)
-            lm_xy = np.squeeze(cv2.transform(lm_xy, mat)).astype(np.int)
-            if self.show_landmarks:
-                list_connections = [[0, 1, 2, 3, 4], 
-                                    [5, 6, 7, 8], 
-                                    [9, 10, 11, 12],
-                                    [13, 14 , 15, 16],
-                                    [17, 18, 19, 20]]
-                palm_line = [np.array([lm_xy[point] for point in [0, 5, 9, 13, 17, 0]])]
+            dst = np.array(region.rect_points[1:], dtype=np.float32) # region.rect_points[0] is left bottom point !
+            mat = cv2.getAffineTransform(LM_REF_POINTS, dst)
+            lm_xy = np.expand_dims(region.landmarks[:,:2], axis=0)
+            lm_xy = np.squeeze(cv2.transform(lm_xy, mat)).astype(int)
+            # Simple condition to determine if palm is palmar or dorsal based on the relative
+            # position of thumb and pinky finger
+            if region.handedness > 0.5:
+                palmar = lm_xy[4][0] > lm_xy[20][0]
+            else:
+                palmar = lm_xy[4][0] < lm_xy[20][0]
 
+            if self.show_landmarks:
                 # Draw lines connecting the palm
-                if region.handedness > 0.5:
-                    # Simple condition to determine if palm is palmar or dorasl based on the relative 
-                    # position of thumb and pinky finger
-                    if lm_xy[4][0] > lm_xy[20][0]:
-                        cv2.polylines(frame, palm_line, False, (255, 255, 255), 2, cv2.LINE_AA)
-                    else:
-                        cv2.polylines(frame, palm_line, False, (128, 128, 128), 2, cv2.LINE_AA)
-                else:
-                    # Simple condition to determine if palm is palmar or dorasl based on the relative 
-                    # position of thumb and pinky finger
-                    if lm_xy[4][0] < lm_xy[20][0]:
-                        cv2.polylines(frame, palm_line, False, (255, 255, 255), 2, cv2.LINE_AA)
-                    else:
-                        cv2.polylines(frame, palm_line, False, (128, 128, 128), 2, cv2.LINE_AA)
-                
-                # Draw line for each finger
-                for i in range(len(list_connections)):
-                    finger = list_connections[i]
-                    line = [np.array([lm_xy[point] for point in finger])]
-                    if region.handedness > 0.5:
-                        if lm_xy[4][0] > lm_xy[20][0]:
-                            palmar = True
-                            cv2.polylines(frame, line, False, FINGER_COLOR[i], 2, cv2.LINE_AA)
-                            for point in finger:
-                                pt = lm_xy[point]
-                                cv2.circle(frame, (pt[0], pt[1]), 3, JOINT_COLOR[i], -1)
-                        else:
-                            palmar = False
+                palm_color = (255, 255, 255) if palmar else (128, 128, 128)
+                cv2.polylines(frame, [lm_xy[PALM_POINTS]], False, palm_color, 2, cv2.LINE_AA)
+
+                # Draw line for each finger, using different colour for the hand to represent dorsal side
+                for i, finger in enumerate(FINGER_CONNECTIONS):
+                    if palmar:
+                        line_color, joint_color = FINGER_COLOR[i], JOINT_COLOR[i]
                     else:
-                        if lm_xy[4][0] < lm_xy[20][0]:
-                            palmar = True
-                            cv2.polylines(frame, line, False, FINGER_COLOR[i], 2, cv2.LINE_AA)
-                            for point in finger:
-                                pt = lm_xy[point]
-                                cv2.circle(frame, (pt[0], pt[1]), 3, JOINT_COLOR[i], -1)
-                        else:
-                            palmar = False
-                    
-                    # Use different colour for the hand to represent dorsal side
-                    if not palmar:
-                        cv2.polylines(frame, line, False, (128, 128, 128), 2, cv2.LINE_AA)
-                        for point in finger:
-                            pt = lm_xy[point]
-                            cv2.circle(frame, (pt[0], pt[1]), 3, (0, 0, 0), -1)
+                        line_color, joint_color = (128, 128, 128), (0, 0, 0)
+                    finger_xy = lm_xy[finger]
+                    cv2.polylines(frame, [finger_xy], False, line_color, 2, cv2.LINE_AA)
+                    for x, y in finger_xy:
+                        cv2.circle(frame, (x, y), 3, joint_color, -1)
 
             # Calculate the bounding box for the entire hand
-            max_x = 0
-            max_y = 0
-            min_x = frame.shape[1]
-            min_y = frame.shape[0]
-            for x,y in lm_xy:
-                if x < min_x:
-                    min_x = x
-                if x > max_x:
-                    max_x = x
-                if y < min_y:
-                    min_y = y
-                if y > max_y:
-                    max_y = y
+            min_x, min_y = np.minimum(lm_xy.min(axis=0), (frame.shape[1], frame.shape[0]))
+            max_x, max_y = np.maximum(lm_xy.max(axis=0), 0)
 
             box_width = max_x - min_x
             box_height = max_y - min_y
@@ -303,59 +274,71 @@ class HandTrackerASL:
 
 
     def run(self):
-        device = dai.Device(self.create_pipeline())
-        device.startPipeline()
-
-        q_video = device.getOutputQueue(name="cam_out", maxSize=1, blocking=False)
-        q_pd_in = device.getInputQueue(name="pd_in")
-        q_pd_out = device.getOutputQueue(name="pd_out", maxSize=4, blocking=True)
-        q_lm_out = device.getOutputQueue(name="lm_out", maxSize=4, blocking=True)
-        q_lm_in = device.getInputQueue(name="lm_in")
-        q_asl_out = device.getOutputQueue(name="asl_out", maxSize=4, blocking=True)
-        q_asl_in = device.getInputQueue(name="asl_in")
-
-        while True:
-            in_video = q_video.get()
-            video_frame = in_video.getCvFrame()
-
-            h, w = video_frame.shape[:2]
+        # Closing the device on exit, even on error, releases the OAK-D for the next run
+        with dai.Device(self.create_pipeline()) as device:
+            device.startPipeline()
+
+            q_video = device.getOutputQueue(name="cam_out", maxSize=1, blocking=False)
+            q_pd_in = device.getInputQueue(name="pd_in")
+            q_pd_out = device.getOutputQueue(name="pd_out", maxSize=4, blocking=True)
+            q_lm_out = device.getOutputQueue(name="lm_out", maxSize=4, blocking=True)
+            q_lm_in = device.getInputQueue(name="lm_in")
+            q_asl_out = device.getOutputQueue(name="asl_out", maxSize=4, blocking=True)
+            q_asl_in = device.getInputQueue(name="asl_in")
+
+            # The preview size is fixed by the pipeline, so the padding to a square frame
+            # only needs to be computed once
+            h, w = self.preview_height, self.preview_width
             self.frame_size = max(h, w)
             self.pad_h = int((self.frame_size - h)/2)
             self.pad_w = int((self.frame_size - w)/2)
 
-            video_frame = cv2.copyMakeBorder(video_frame, self.pad_h, self.pad_h, self.pad_w, self.pad_w, cv2.BORDER_CONSTANT)
+            while True:
+                in_video = q_video.get()
+                video_frame = in_video.getCvFrame()
+
+                # A square preview is used as is, only other sizes need to be copied into a padded frame
+                if self.pad_h or self.pad_w:
+                    video_frame = cv2.copyMakeBorder(video_frame, self.pad_h, self.pad_h, self.pad_w, self.pad_w, cv2.BORDER_CONSTANT)
             
-            frame_nn = dai.ImgFrame()
-            frame_nn.setWidth(self.pd_input_length)
-            frame_nn.setHeight(self.pd_input_length)
-            frame_nn.setData(to_planar(video_frame, (self.pd_input_length, self.pd_input_length)))
-            q_pd_in.send(frame_nn)
-
-            annotated_frame = video_frame.copy()
-
-            # Get palm detection
-            inference = q_pd_out.get()
-            self.pd_postprocess(inference)
-
-            # Send data for hand landmarks
-            for i,r in enumerate(self.regions):
-                img_hand = mpu.warp_rect_img(r.rect_points, video_frame, self.lm_input_length, self.lm_input_length)
-                nn_data = dai.NNData()   
-                nn_data.setLayer("input_1", to_planar(img_hand, (self.lm_input_length, self.lm_input_length)))
-                q_lm_in.send(nn_data)
-
-            # Retrieve hand landmarks
-            for i,r in enumerate(self.regions):
-                inference = q_lm_out.get()
-                self.lm_postprocess(r, inference)
-                hand_frame, handedness, hand_bbox = self.lm_render(video_frame, annotated_frame, r)
+                frame_nn = dai.ImgFrame()
+                frame_nn.setWidth(self.pd_input_length)
+                frame_nn.setHeight(self.pd_input_length)
+                frame_nn.setData(to_planar(video_frame, (self.pd_input_length, self.pd_input_length)))
+                q_pd_in.send(frame_nn)
+
+                # Clean copy of the frame used to crop hands, reusing the same buffer every frame
+                if self.annotated_frame is None or self.annotated_frame.shape != video_frame.shape:
+                    self.annotated_frame = np.empty_like(video_frame)
+                np.copyto(self.annotated_frame, video_frame)
+                annotated_frame = self.annotated_frame
+
+                # Get palm detection
+                inference = q_pd_out.get()
+                self.pd_postprocess(inference)
+
+                # Send data for hand landmarks
+                for i,r in enumerate(self.regions):
+                    img_hand = mpu.warp_rect_img(r.rect_points, video_frame, self.lm_input_length, self.lm_input_length)
+                    nn_data = dai.NNData()   
+                    nn_data.setLayer("input_1", to_planar(img_hand, (self.lm_input_length, self.lm_input_length)))
+                    q_lm_in.send(nn_data)
+
+                # Retrieve hand landmarks and send the cropped hands for ASL recognition
+                asl_hands = []
+                for i,r in enumerate(self.regions):
+                    inference = q_lm_out.get()
+                    self.lm_postprocess(r, inference)
+                    hand_frame, handedness, hand_bbox = self.lm_render(video_frame, annotated_frame, r)
+                    if hand_frame is not None and self.asl_recognition:
+                        hand_frame = to_planar(hand_frame, (self.asl_input_length, self.asl_input_length))
+                        nn_data = dai.NNData()
+                        nn_data.setLayer("input", hand_frame)
+                        q_asl_in.send(nn_data)
+                        asl_hands.append((handedness, hand_bbox))
+
                 # ASL recognition
-                if hand_frame is not None and self.asl_recognition:
-                    hand_frame = cv2.resize(hand_frame, (self.asl_input_length, self.asl_input_length), interpolation=cv2.INTER_NEAREST)
-                    hand_frame = hand_frame.transpose(2,0,1)
-                    nn_data = dai.NNData()
-                    nn_data.setLayer("input", hand_frame)
-                    q_asl_in.send(nn_data)
+                for handedness, hand_bbox in asl_hands:
                     asl_result = np.array(q_asl_out.get().getFirstLayerFp16())
                     asl_idx = np.argmax(asl_result)
                     # Recognized ASL character is associated with a probability
@@ -372,43 +355,31 @@ class HandTrackerASL:
                     if len(current_char_queue) < 5:
                         selected_char = current_char_queue[0]
                     else:
-                        char_candidate = {}
-                        for i in range(5):
-                            if current_char_queue[i][0] not in char_candidate:
-                                char_candidate[current_char_queue[i][0]] = [1, current_char_queue[i][1]]
-                            else:
-                                char_candidate[current_char_queue[i][0]][0] += 1
-                                char_candidate[current_char_queue[i][0]][1] += current_char_queue[i][1]
-                        most_voted_char = ""
-                        max_votes = 0
-                        most_voted_char_prob = 0
-                        for key in char_candidate:
-                            if char_candidate[key][0] > max_votes:
-                                max_votes = char_candidate[key][0]
-                                most_voted_char = key
-                                most_voted_char_prob = round(char_candidate[key][1] / char_candidate[key][0], 1)
+                        # Ties go to the character seen first, as most_common keeps insertion order
+                        votes = collections.Counter(c for c, _ in current_char_queue)
+                        most_voted_char, max_votes = votes.most_common(1)[0]
+                        most_voted_char_prob = round(sum(p for c, p in current_char_queue if c == most_voted_char) / max_votes, 1)
                         selected_char = (most_voted_char, most_voted_char_prob)
-                    
+                
                     if self.show_asl:
                         gesture_string = "Letter: " + selected_char[0] + ", " + str(selected_char[1]) + "%"
                         textSize = self.ft.getTextSize(gesture_string, fontHeight=14, thickness=-1)[0]
                         cv2.rectangle(video_frame, (hand_bbox[0] - 5, hand_bbox[1]), (hand_bbox[0] + textSize[0] + 5, hand_bbox[1] - 18), (36, 152, 0), -1)
                         self.ft.putText(img=video_frame, text=gesture_string , org=(hand_bbox[0], hand_bbox[1] - 5), fontHeight=14, color=(255, 255, 255), thickness=-1, line_type=cv2.LINE_AA, bottomLeftOrigin=True)
 
-            video_frame = video_frame[self.pad_h:self.pad_h+h, self.pad_w:self.pad_w+w]
-            cv2.imshow("hand tracker", video_frame)
-            key = cv2.waitKey(1) 
-            if key == ord('q') or key == 27:
-                break
-            elif key == 32:
-                # Pause on space bar
-                cv2.waitKey(0)
-            elif key == ord('1'):
-                self.show_hand_box = not self.show_hand_box
-            elif key == ord('2'):
-                self.show_landmarks = not self.show_landmarks
-            elif key == ord('3'):
-                self.show_asl = not self.show_asl
+                video_frame = video_frame[self.pad_h:self.pad_h+h, self.pad_w:self.pad_w+w]
+                cv2.imshow("hand tracker", video_frame)
+                key = cv2.waitKey(1) 
+                if key == ord('q') or key == 27:
+                    break
+                elif key == 32:
+                    # Pause on space bar
+                    cv2.waitKey(0)
+                elif key in TOGGLE_KEYS:
+                    attr = TOGGLE_KEYS[key]
+                    setattr(self, attr, not getattr(self, attr))
+
+        cv2.destroyAllWindows()
 
 
 if __name__ == "__main__":
@@ -423,5 +394,7 @@ if __name__ == "__main__":
                         help="enable ASL recognition")
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     ht = HandTrackerASL(pd_path=args.pd_m, lm_path=args.lm_m, asl_path=args.asl_m, asl_recognition=args.asl)
     ht.run()
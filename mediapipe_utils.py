@@ -5,14 +5,21 @@ from math import ceil, sqrt, exp, pi, floor, sin, cos, atan2
 
 
 class HandRegion:
+    # Regions are created for every palm detection, slots keep them small and fast to fill.
+    # Attributes after pd_kps are set by detections_to_rect, rect_transformation and lm_postprocess
+    __slots__ = ('pd_score', 'pd_box', 'pd_kps',
+                 'rect_w', 'rect_h', 'rect_x_center', 'rect_y_center', 'rotation',
+                 'rect_x_center_a', 'rect_y_center_a', 'rect_w_a', 'rect_h_a', 'rect_points',
+                 'lm_score', 'handedness', 'landmarks')
+
     def __init__(self, pd_score, pd_box, pd_kps=0):
         self.pd_score = pd_score # Palm detection score 
         self.pd_box = pd_box # Palm detection box [x, y, w, h] normalized
         self.pd_kps = pd_kps # Palm detection keypoints
 
     def print(self):
-        attrs = vars(self)
-        print('\n'.join("%s: %s" % item for item in attrs.items()))
+        attrs = ((name, getattr(self, name)) for name in self.__slots__ if hasattr(self, name))
+        print('\n'.join("%s: %s" % item for item in attrs))
 
 
 SSDAnchorOptions = namedtuple('SSDAnchorOptions',[
@@ -78,24 +85,22 @@ def generate_anchors(options):
         feature_map_height = ceil(options.input_size_height / stride)
         feature_map_width = ceil(options.input_size_width / stride)
 
-        for y in range(feature_map_height):
-            for x in range(feature_map_width):
-                for anchor_id in range(len(anchor_height)):
-                    x_center = (x + options.anchor_offset_x) / feature_map_width
-                    y_center = (y + options.anchor_offset_y) / feature_map_height
-                    # new_anchor = Anchor(x_center=x_center, y_center=y_center)
-                    if options.fixed_anchor_size:
-                        new_anchor = [x_center, y_center, 1.0, 1.0]
-                        # new_anchor.w = 1.0
-                        # new_anchor.h = 1.0
-                    else:
-                        new_anchor = [x_center, y_center, anchor_width[anchor_id], anchor_height[anchor_id]]
-                        # new_anchor.w = anchor_width[anchor_id]
-                        # new_anchor.h = anchor_height[anchor_id]
-                    anchors.append(new_anchor)
-        
+        # Anchors of the whole feature map are filled at once, laid out in the same
+        # (y, x, anchor_id) order as the nested loops of the mediapipe calculator
+        x_center = (np.arange(feature_map_width) + options.anchor_offset_x) / feature_map_width
+        y_center = (np.arange(feature_map_height) + options.anchor_offset_y) / feature_map_height
+        layer_anchors = np.empty((feature_map_height, feature_map_width, len(anchor_height), 4), dtype=np.float32)
+        layer_anchors[..., 0] = x_center[None, :, None]
+        layer_anchors[..., 1] = y_center[:, None, None]
+        if options.fixed_anchor_size:
+            layer_anchors[..., 2:4] = 1.0
+        else:
+            layer_anchors[..., 2] = anchor_width
+            layer_anchors[..., 3] = anchor_height
+        anchors.append(layer_anchors.reshape(-1, 4))
+
         layer_id = last_same_stride_layer
-    return np.array(anchors)
+    return np.concatenate(anchors)
 
 
 def decode_bboxes(score_thresh, scores, bboxes, anchors):
@@ -138,10 +143,15 @@ def decode_bboxes(score_thresh, scores, bboxes, anchors):
     bboxes: shape = [ number of anchors x 18], 18 = 4 (bounding box : (cx,cy,w,h) + 14 (7 palm keypoints)
     """
     regions = []
-    scores = 1 / (1 + np.exp(-scores))
-    detection_mask = scores > score_thresh
-    det_scores = scores[detection_mask]
-    if det_scores.size == 0: return regions
+    # sigmoid(score) > score_thresh  <=>  score > logit(score_thresh), so the raw scores are
+    # compared to a precomputed threshold and the sigmoid is only applied to the detections kept.
+    # The logit saturates to -inf/+inf for thresholds 0/1 (everything/nothing passes). It is kept
+    # a Python float so the comparison runs at the precision of the scores, like the sigmoid did
+    with np.errstate(divide='ignore'):
+        logit_thresh = float(np.log(score_thresh) - np.log1p(-score_thresh))
+    detection_mask = scores > logit_thresh
+    if not detection_mask.any(): return regions
+    det_scores = 1 / (1 + np.exp(-scores[detection_mask]))
     det_bboxes = bboxes[detection_mask]
     det_anchors = anchors[detection_mask]
     scale = 128 # x_scale, y_scale, w_scale, h_scale
@@ -151,29 +161,26 @@ def decode_bboxes(score_thresh, scores, bboxes, anchors):
     # cy = cy * anchor.h / hi + anchor.y_center
     # lx = lx * anchor.w / wi + anchor.x_center 
     # ly = ly * anchor.h / hi + anchor.y_center
-    det_bboxes = det_bboxes* np.tile(det_anchors[:,2:4], 9) / scale + np.tile(det_anchors[:,0:2],9)
+    # The 9 (x, y) pairs of each detection are decoded at once by broadcasting its anchor
+    det_bboxes = (det_bboxes.reshape(-1, 9, 2) * det_anchors[:,None,2:4] / scale + det_anchors[:,None,0:2]).reshape(-1, 18)
     # w = w * anchor.w / wi (in the prvious line, we add anchor.x_center and anchor.y_center to w and h, we need to substract them now)
     # h = h * anchor.h / hi
     det_bboxes[:,2:4] = det_bboxes[:,2:4] - det_anchors[:,0:2]
     # box = [cx - w*0.5, cy - h*0.5, w, h]
     det_bboxes[:,0:2] = det_bboxes[:,0:2] - det_bboxes[:,3:4] * 0.5
 
+    # Keypoints as a (n, 7, 2) view on det_bboxes:
+    # 0 : wrist
+    # 1 : index finger joint
+    # 2 : middle finger joint
+    # 3 : ring finger joint
+    # 4 : little finger joint
+    # 5 :
+    # 6 : thumb joint
+    det_kps = det_bboxes[:,4:].reshape(-1, 7, 2)
+
     for i in range(det_bboxes.shape[0]):
-        score = det_scores[i]
-        box = det_bboxes[i,0:4]
-        kps = []
-        # 0 : wrist
-        # 1 : index finger joint
-        # 2 : middle finger joint
-        # 3 : ring finger joint
-        # 4 : little finger joint
-        # 5 : 
-        # 6 : thumb joint
-        # for j, name in enumerate(["0", "1", "2", "3", "4", "5", "6"]):
-        #     kps[name] = det_bboxes[i,4+j*2:6+j*2]
-        for kp in range(7):
-            kps.append(det_bboxes[i,4+kp*2:6+kp*2])
-        regions.append(HandRegion(float(score), box, kps))
+        regions.append(HandRegion(float(det_scores[i]), det_bboxes[i,0:4], det_kps[i]))
     return regions
 
 def non_max_suppression(regions, nms_thresh):
@@ -182,7 +189,7 @@ def non_max_suppression(regions, nms_thresh):
     # boxes = [ [x, y, w, h], ...] with x, y, w, h of type int
     # Currently, x, y, w, h are float between 0 and 1, so we arbitrarily multiply by 1000 and cast to int
     # boxes = [r.box for r in regions]
-    boxes = [ [int(x*1000) for x in r.pd_box] for r in regions]        
+    boxes = (np.array([r.pd_box for r in regions]) * 1000).astype(int).tolist()
     scores = [r.pd_score for r in regions]
     indices = cv2.dnn.NMSBoxes(boxes, scores, 0, nms_thresh)
     return [regions[i[0]] for i in indices]
@@ -192,7 +199,8 @@ def normalize_radians(angle):
 
 def rot_vec(vec, rotation):
     vx, vy = vec
-    return [vx * cos(rotation) - vy * sin(rotation), vx * sin(rotation) + vy * cos(rotation)]
+    c, s = cos(rotation), sin(rotation)
+    return [vx * c - vy * s, vx * s + vy * c]
 
 def detections_to_rect(regions):
     # https://github.com/google/mediapipe/blob/master/mediapipe/modules/hand_landmark/palm_detection_detection_to_roi.pbtxt
@@ -229,7 +237,6 @@ def detections_to_rect(regions):
 def rotated_rect_to_points(cx, cy, w, h, rotation, wi, hi):
     b = cos(rotation) * 0.5
     a = sin(rotation) * 0.5
-    points = []
     p0x = cx - a*h - b*w
     p0y = cy + b*h - a*w
     p1x = cx + a*h - b*w
@@ -273,8 +280,9 @@ def rect_transformation(regions, w, h):
             region.rect_x_center_a = (region.rect_x_center + width * shift_x) * w
             region.rect_y_center_a = (region.rect_y_center + height * shift_y) * h
         else:
-            x_shift = (w * width * shift_x * cos(rotation) - h * height * shift_y * sin(rotation)) #/ w
-            y_shift = (w * width * shift_x * sin(rotation) + h * height * shift_y * cos(rotation)) #/ h
+            c, s = cos(rotation), sin(rotation)
+            x_shift = (w * width * shift_x * c - h * height * shift_y * s) #/ w
+            y_shift = (w * width * shift_x * s + h * height * shift_y * c) #/ h
             region.rect_x_center_a = region.rect_x_center*w + x_shift
             region.rect_y_center_a = region.rect_y_center*h + y_shift
 